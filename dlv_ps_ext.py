@@ -42,8 +42,16 @@
 #               sleep_mode=True)
 # pressure, temperature, status = dlv.measure()
 #
+#
+# Sample usage zero-offset calibration, open pipes, stored on flash:
+#
+# dlv = DLV_I2C(i2c, calibration="dlv_cal.bin")
+# offset, sem, n = dlv.calibrate(file="dlv_cal.bin")
+#
 
 import time
+import struct
+from array import array
 
 
 class DLV_PS:
@@ -63,9 +71,12 @@ class DLV_PS:
 
     _I2C_ADDRESS = 0x28
     _WAKEUP_TIME = 2  # Wakeup-time from sleep mode
+    _CAL_MAGIC = b"DLVC"
+    _CAL_HEADER = "<4sfHH"  # magic, offset, temp_step in 0.01 C, number of bins
+    _CAL_BIN = "<hf"  # bin index, offset
 
 
-    def __init__(self, model, offset):
+    def __init__(self, model, offset, calibration=None):
         assert model.upper() in self._models.keys(), "Wrong model type"
 
         self.scaling, self.offset =  self._models[model.upper()] # set defaults
@@ -73,6 +84,11 @@ class DLV_PS:
             self.offset = offset
         self.scaling = 1.25 * self.scaling / 16384  # precalulate the coefficient
 
+        self.temp_step = 0
+        self.offset_table = {}
+        if calibration is not None:
+            self.load_calibration(calibration)
+
         self.data = bytearray(4)
         self.data2 = bytearray(2)
 
@@ -88,14 +104,17 @@ class DLV_PS:
         status = (self.data[0] >> 6) & 0x03
         if status == 0b00 or status == 0b10:  # data valid, may be old
             pressure = ((self.data[0] << 8) | self.data[1]) & 0x3FFF
-            if cooked:
-                pressure = self.psi(pressure)
             if all:
                 temperature = (self.data[2] << 3) | ((self.data[3] >> 5) & 0x07)
+                if self.offset_table:  # track the offset with the temperature
+                    self.offset = self._table_offset(self.celsius(temperature))
                 if cooked:
+                    pressure = self.psi(pressure)
                     temperature = self.celsius(temperature)
                 return pressure, temperature, status
             else:
+                if cooked:
+                    pressure = self.psi(pressure)
                 return pressure, status
         else:
             raise RuntimeError("Status: {}".format(status))
@@ -132,14 +151,203 @@ class DLV_PS:
         self.value += self.tau * (value - self.value)
         return self.value
 
+#
+# Sliding window least-squares line through the raw samples, e.g. for
+# leak tests. The sums are kept as integers relative to the oldest sample
+# in the ring buffer, such that each update is O(1) and exact, and the
+# values stay bounded by the window. A window with a slope of more than
+# threshold mbar/s fails, one with less passes. The decision is reported
+# once by callback(passed, slope) after at least min_samples samples, as
+# soon as the slope differs from threshold by more than k standard errors,
+# with k widened to a Student-t factor for small windows. At least 5
+# samples are required, below the approximation of the factor is too low.
+#
+    def slope_init(self, size, threshold=None, callback=None, k=2.0,
+                   min_samples=None):
+        assert size >= 5, "Window too small"
+        self.slope_size = size
+        self.slope_t = array("i", bytearray(4 * size))
+        self.slope_p = array("i", bytearray(4 * size))
+        self.slope_index = 0
+        self.slope_n = 0
+        self.slope_t0 = 0  # ticks and pressure of the oldest sample
+        self.slope_p0 = 0
+        self.slope_sums = [0, 0, 0, 0, 0]  # St, Sp, Stt, Stp, Spp
+        self.slope_threshold = threshold
+        self.slope_callback = callback
+        if min_samples is None:
+            min_samples = size
+        self.slope_min = min(max(min_samples, 5), size)
+        # Cornish-Fisher terms for the Student-t factor of k
+        self.slope_k = (k, (k ** 3 + k) / 4, (5 * k ** 5 + 16 * k ** 3 + 3 * k) / 96,
+                        (3 * k ** 7 + 19 * k ** 5 + 17 * k ** 3 - 15 * k) / 384)
+
+    def slope(self, pressure, ticks=None):
+        if ticks is None:
+            ticks = time.ticks_ms()
+        sums = self.slope_sums
+        index = self.slope_index
+        n = self.slope_n
+        if n == 0:
+            self.slope_t0 = ticks
+            self.slope_p0 = pressure
+        elif n == self.slope_size:  # drop the oldest sample, rebase to the next
+            n -= 1  # the oldest sample is (0, 0), so only the count changes
+            nxt = (index + 1) % self.slope_size
+            d = time.ticks_diff(self.slope_t[nxt], self.slope_t0)
+            e = self.slope_p[nxt] - self.slope_p0
+            st = sums[0]
+            sp = sums[1]
+            sums[0] = st - n * d
+            sums[1] = sp - n * e
+            sums[2] += n * d * d - 2 * d * st
+            sums[3] += n * d * e - d * sp - e * st
+            sums[4] += n * e * e - 2 * e * sp
+            self.slope_t0 = self.slope_t[nxt]
+            self.slope_p0 = self.slope_p[nxt]
+        t = time.ticks_diff(ticks, self.slope_t0)
+        p = pressure - self.slope_p0
+        self.slope_t[index] = ticks
+        self.slope_p[index] = pressure
+        sums[0] += t
+        sums[1] += p
+        sums[2] += t * t
+        sums[3] += t * p
+        sums[4] += p * p
+        n += 1
+        self.slope_n = n
+        self.slope_index = (index + 1) % self.slope_size
+
+        if n < 3:
+            return None
+        dtt = n * sums[2] - sums[0] * sums[0]  # integer, hence exact
+        if dtt == 0:
+            return None
+        dtp = n * sums[3] - sums[0] * sums[1]
+        dpp = n * sums[4] - sums[1] * sums[1]
+        b = dtp / dtt  # raw counts per ms
+        variance = max((dpp - b * dtp) / n, 0) / (n - 2)
+        a = (sums[1] - b * sums[0]) / n + self.slope_p0  # raw value at the oldest sample
+        to_mbar = self.mbar(self.scaling)
+        slope = b * 1000 * to_mbar  # mbar/s
+        if (self.slope_callback is not None and self.slope_threshold is not None
+                and n >= self.slope_min):
+            k, c1, c2, c3 = self.slope_k
+            df = n - 2
+            k += (c1 + (c2 + c3 / df) / df) / df
+            # the noise is at least the quantization noise of 1/12 counts^2
+            margin = k * (max(variance, 1 / 12) * n / dtt) ** 0.5 * 1000 * to_mbar
+            if abs(slope) - margin > self.slope_threshold:
+                self.slope_callback(False, slope)
+                self.slope_callback = None
+            elif abs(slope) + margin < self.slope_threshold:
+                self.slope_callback(True, slope)
+                self.slope_callback = None
+        return slope, self.mbar(self.psi(a)), variance ** 0.5 * to_mbar
+
+#
+# Zero-offset calibration. Has to be run with no pressure applied (open pipes).
+# The raw readings are fed into a running mean/variance (Welford), and the
+# run stops as soon as the standard error of the mean is below max_sem.
+# With temp_step > 0 a table of offsets per temperature bin of temp_step
+# degree Celsius is kept, and measure(all=True) picks the offset from it.
+# With temp_step == 0 an existing table is dropped. temp_step is rounded to
+# 0.01 degree Celsius, such that it survives storing exactly.
+#
+    def calibrate(self, max_samples=1000, min_samples=16, max_sem=0.05,
+                  temp_step=0, interval=0, file=None):
+        step = int(round(temp_step * 100))  # the stored form
+        assert temp_step == 0 or 1 <= step <= 0xFFFF, "Wrong temp_step"
+        temp_step = step / 100
+        min_samples = max(min_samples, 2)  # the standard error needs two
+        n = 0
+        mean = 0.0
+        m2 = 0.0
+        bins = {}
+        for i in range(max_samples):
+            if interval and i:
+                time.sleep_ms(interval)
+            pressure, temperature, status = self.measure(all=True, cooked=False)
+            if status != 0b00:  # skip stale values, they would bias the variance
+                continue
+            n += 1
+            delta = pressure - mean
+            mean += delta / n
+            m2 += delta * (pressure - mean)
+            if temp_step:
+                index = int(self.celsius(temperature) // temp_step)
+                stat = bins.get(index)
+                if stat is None:
+                    bins[index] = stat = [0, 0.0]
+                stat[0] += 1
+                stat[1] += (pressure - stat[1]) / stat[0]
+            if n >= min_samples and m2 <= max_sem * max_sem * n * (n - 1):
+                break
+        if n < 2:
+            raise RuntimeError("Calibration failed: not enough valid samples")
+
+        self.offset = mean
+        if temp_step:
+            if temp_step != self.temp_step:  # bins do not match, start over
+                self.offset_table = {}
+                self.temp_step = temp_step
+            for index in bins:
+                self.offset_table[index] = bins[index][1]
+        else:  # a plain offset replaces any old table
+            self.offset_table = {}
+            self.temp_step = 0
+        if file is not None:
+            self.save_calibration(file)
+        return mean, (m2 / (n * (n - 1))) ** 0.5, n
+
+    def _table_offset(self, temperature):
+        index = int(temperature // self.temp_step)
+        if index in self.offset_table:
+            return self.offset_table[index]
+        nearest = min(self.offset_table, key=lambda i: abs(i - index))
+        return self.offset_table[nearest]
+
+    def save_calibration(self, file):
+        with open(file, "wb") as f:
+            f.write(struct.pack(self._CAL_HEADER, self._CAL_MAGIC, self.offset,
+                                int(round(self.temp_step * 100)),
+                                len(self.offset_table)))
+            for index in self.offset_table:
+                f.write(struct.pack(self._CAL_BIN, index, self.offset_table[index]))
+
+    def load_calibration(self, file):
+        try:
+            with open(file, "rb") as f:
+                data = f.read()
+        except OSError:
+            return False  # no calibration stored yet
+        header_size = struct.calcsize(self._CAL_HEADER)
+        bin_size = struct.calcsize(self._CAL_BIN)
+        if len(data) < header_size:
+            raise ValueError("Invalid calibration data")
+        magic, offset, temp_step, count = struct.unpack(
+            self._CAL_HEADER, data[:header_size])
+        if (magic != self._CAL_MAGIC or len(data) != header_size + count * bin_size
+                or (count and temp_step == 0)):
+            raise ValueError("Invalid calibration data")
+        table = {}
+        for pos in range(header_size, len(data), bin_size):
+            index, value = struct.unpack(self._CAL_BIN, data[pos:pos + bin_size])
+            table[index] = value
+        self.offset = offset
+        self.temp_step = temp_step / 100
+        self.offset_table = table
+        return True
+
 class DLV_I2C(DLV_PS):
-    def __init__(self, i2c, model="030G", offset=None, sleep_mode=False):
+    def __init__(self, i2c, model="030G", offset=None, sleep_mode=False,
+                 calibration=None):
         assert self._I2C_ADDRESS in i2c.scan(), "Device not accessible"
         self.i2c = i2c
         self.sleep_mode = sleep_mode
         self.address = bytearray(1)
         self.address[0] = (self._I2C_ADDRESS << 1) | 1
-        super().__init__(model, offset)
+        super().__init__(model, offset, calibration)
 
     def read_data(self, all):
         if self.sleep_mode:  # Start cmd only in sleep mode
@@ -169,7 +377,8 @@ class DLV_I2C(DLV_PS):
 # use the SPI interface.
 #
 class DLV_SPI(DLV_PS):
-    def __init__(self, interface, model="030G", offset=None, sleep_mode=False):
+    def __init__(self, interface, model="030G", offset=None, sleep_mode=False,
+                 calibration=None):
         if len(interface) == 2:
             self.spi, self.cs = interface
             self.cs(1)
@@ -180,7 +389,7 @@ class DLV_SPI(DLV_PS):
             self.cs(1)
             self.has_spi = False
         self.sleep_mode = sleep_mode
-        super().__init__(model, offset)
+        super().__init__(model, offset, calibration)
 
     def read_data(self, all):
         if self.sleep_mode:  # Start cmd only in sleep mode